@@ -13,8 +13,7 @@ def preprocess_data(args):
 
     print(f"Data path is {data_path}")
 
-    if not os.path.exists(args.dset.save_path):
-        os.mkdir(args.dset.save_path)
+    os.makedirs(args.dset.save_path, exist_ok=True)
 
     file_list_pkl = os.path.join(args.dset.save_path, file_name)
     if os.path.exists(file_list_pkl):
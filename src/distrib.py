@@ -121,9 +121,14 @@ def load_dataset(args):
         path_to_dataset = path_to_dataset + "_debug"
     path_to_dataset = Path(path_to_dataset)
 
-    # get training and validation tf record file names
-    train_tfrecords_filenames = glob.glob(os.path.join(path_to_dataset, "train_*"))
-    val_tfrecords_filenames = glob.glob(os.path.join(path_to_dataset, "val_*"))
+    # get training and validation tf record file names,
+    # only GZIP shards (not legacy per-segment records or unfinished .tmp shards)
+    train_tfrecords_filenames = glob.glob(
+        os.path.join(path_to_dataset, "train_shard*.tfrecords")
+    )
+    val_tfrecords_filenames = glob.glob(
+        os.path.join(path_to_dataset, "val_shard*.tfrecords")
+    )
 
     # shuffle the file names for training
     np.random.shuffle(train_tfrecords_filenames)
@@ -144,21 +149,23 @@ def load_dataset(args):
                 "clean_stft_real": tf.io.FixedLenFeature((), tf.string),
                 "noisy_stft_imag": tf.io.FixedLenFeature((), tf.string),
                 "clean_stft_imag": tf.io.FixedLenFeature((), tf.string),
+                "dtype": tf.io.FixedLenFeature((), tf.string),
             }
             features = tf.io.parse_single_example(record, keys_to_features)
 
-            noisy_stft_real = tf.io.decode_raw(
-                features["noisy_stft_real"], tf.float32
+            def decode_stft(raw):
+                return tf.cond(
+                    tf.equal(features["dtype"], "float16"),
+                    lambda: tf.cast(tf.io.decode_raw(raw, tf.float16), tf.float32),
+                    lambda: tf.io.decode_raw(raw, tf.float32),
+                )
+
+            noisy_stft_real = decode_stft(
+                features["noisy_stft_real"]
             )  # phase scaling by clean wav
-            clean_stft_real = tf.io.decode_raw(
-                features["clean_stft_real"], tf.float32
-            )
-            noisy_stft_imag = tf.io.decode_raw(
-                features["noisy_stft_imag"], tf.float32
-            )
-            clean_stft_imag = tf.io.decode_raw(
-                features["clean_stft_imag"], tf.float32
-            )
+            clean_stft_real = decode_stft(features["clean_stft_real"])
+            noisy_stft_imag = decode_stft(features["noisy_stft_imag"])
+            clean_stft_imag = decode_stft(features["clean_stft_imag"])
             
             noisy_feature = tf.complex(real=noisy_stft_real, imag=noisy_stft_imag)
             clean_feature = tf.complex(real=clean_stft_real, imag=clean_stft_imag)
@@ -209,7 +216,11 @@ def load_dataset(args):
       batch: same as batch concept
       prefetch: prepare while training, if set the buffer size as tf.data.experimental.AUTOTUNE, it use automatic method in keras
     """
-    train_dataset = tf.data.TFRecordDataset([train_tfrecords_filenames])
+    train_dataset = tf.data.TFRecordDataset(
+        [train_tfrecords_filenames],
+        compression_type="GZIP",
+        num_parallel_reads=tf.data.experimental.AUTOTUNE,
+    )
     train_dataset = train_dataset.map(tf_record_parser)
     train_dataset = train_dataset.shuffle(8192)
     train_dataset = train_dataset.repeat()
@@ -223,7 +234,11 @@ def load_dataset(args):
     train_dataset = train_dataset.apply(tf.data.experimental.ignore_errors())
 
     # val_dataset
-    test_dataset = tf.data.TFRecordDataset([val_tfrecords_filenames])
+    test_dataset = tf.data.TFRecordDataset(
+        [val_tfrecords_filenames],
+        compression_type="GZIP",
+        num_parallel_reads=tf.data.experimental.AUTOTUNE,
+    )
     test_dataset = test_dataset.map(tf_record_parser)
     test_dataset = test_dataset.repeat(1)
     test_dataset = test_dataset.batch(args.batch_size)
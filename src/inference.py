@@ -142,7 +142,7 @@ def inference(clean_file, noisy_file, args, return_metric=False):
 
     metric_sisdr = None
     if return_metric:
-        filename = clean_file.split('/')[-1].split('.')[0]
+        filename = Path(clean_file).stem
         metric_sisdr = {filename:{}}
         
         if model_name in ("unet", "conv-tasnet"):
@@ -213,7 +213,7 @@ def main(gpu_size, path_conf):
         clean_audio, noisy_audio, estimation, metrics_file = inference(clean_file, noisy_file, args, return_metric=True)
 
         if args.test.save:
-            filename = clean_file.split('/')[-1].split('.')[0]
+            filename = Path(clean_file).stem
             save_path = model_path / "audio"
             file_save_path = save_path / filename
             metric_save_path = file_save_path / "result_metric.json"
@@ -221,9 +221,9 @@ def main(gpu_size, path_conf):
             if not file_save_path.is_dir():
                 file_save_path.mkdir(parents=True, exist_ok=True)
 
-            estimate_file_name = f"{clean_file.split('/')[-1].split('.')[0]}_estimate.wav"
-            clean_file_name = f"{clean_file.split('/')[-1].split('.')[0]}_clean.wav"
-            noisy_file_name = f"{clean_file.split('/')[-1].split('.')[0]}_noisy.wav"
+            estimate_file_name = f"{filename}_estimate.wav"
+            clean_file_name = f"{filename}_clean.wav"
+            noisy_file_name = f"{filename}_noisy.wav"
             
             clean_file = os.path.join(file_save_path, clean_file_name)
             noisy_file = os.path.join(file_save_path, noisy_file_name)
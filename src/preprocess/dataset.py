@@ -6,13 +6,18 @@
  longer than 200 ms had been trimmed off from the beginning and end of each sentence.
 """
 import os
+import math
+import itertools
+import contextlib
 import tqdm
+import numba
 import librosa
 import numpy as np
 import tensorflow as tf
 from pathlib import Path
+import multiprocessing
 from concurrent.futures import ProcessPoolExecutor
-from .feature_extractor import FeatureExtractor
+from multiprocessing import shared_memory
 from src.utils import (
     get_tf_feature_real_imag_pair,
     get_tf_feature_mag_phase_pair,
@@ -20,14 +25,81 @@ from src.utils import (
     read_audio,
     segment_audio,
     encode_normalize,
+    stft_tensorflow,
 )
 
 # import logging
-# import math
-# import multiprocessing
 # from sklearn.preprocessing import StandardScaler
 
 
+@numba.njit(parallel=True, fastmath=True, cache=True)
+def _phase_aware(magnitude, clean_phase, noise_phase):
+    """magnitude * cos(clean_phase - noise_phase) in a single pass"""
+    out = np.empty_like(magnitude)
+    out_flat = out.reshape(-1)
+    magnitude, clean_phase, noise_phase = (
+        magnitude.ravel(),
+        clean_phase.ravel(),
+        noise_phase.ravel(),
+    )
+    for i in numba.prange(out_flat.size):
+        out_flat[i] = magnitude[i] * math.cos(clean_phase[i] - noise_phase[i])
+    return out
+
+
+def _pack_examples(examples):
+    """Serialized examples in a single buffer, with offsets of each example"""
+    offsets = np.cumsum([0] + [len(example) for example in examples])
+    return b"".join(examples), offsets
+
+
+def _unpack_examples(buffer, offsets):
+    for start, end in zip(offsets[:-1], offsets[1:]):
+        yield bytes(buffer[start:end])
+
+
+def _write_shared_memory(writer, shm_name, offsets):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        for example in _unpack_examples(shm.buf, offsets):
+            writer.write(example)
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def _unlink_shared_memory(results):
+    """Drains worker results which won't be written down and unlinks their records"""
+    while True:
+        try:
+            shm_name, _ = next(results)
+        except StopIteration:
+            return
+        except Exception:  # failed task, the iterator stops after it
+            continue
+        shm = shared_memory.SharedMemory(name=shm_name)
+        shm.close()
+        shm.unlink()
+
+
+@tf.function(jit_compile=True, reduce_retracing=True)
+def _stft_features(audio, frame_length, frame_step, fft_length, center):
+    """Batched stft over every (audio, segment) in a single call,
+    fused with real/imag extraction by XLA
+    """
+    audio = tf.cast(audio, tf.float32)
+    spectrogram = stft_tensorflow(
+        audio,
+        nfft=frame_length,
+        hop_length=frame_step,
+        center=center,
+        normalize=False,
+        fft_length=fft_length,
+    )
+    # ..., frame, frequency(fft_length // 2 + 1, rfft)
+    return tf.math.real(spectrogram), tf.math.imag(spectrogram)
+
+
 class DatasetVoiceBank:
     def __init__(self, clean_filenames, noisy_filenames, name, args, debug=False):
         self.clean_filenames = clean_filenames
@@ -36,12 +108,15 @@ class DatasetVoiceBank:
         self.args = args
         self.debug = debug
 
+        assert all(
+            os.path.basename(clean_filename) == os.path.basename(noisy_filename)
+            for clean_filename, noisy_filename in zip(clean_filenames, noisy_filenames)
+        ), "filename must match."
+
     def _sample_noisy_filename(self):
         return np.random.choice(self.noisy_filenames)
 
     def _remove_silent_frames(self, audio, index_indices=None, name=None):
-        trimed_audio = []
-
         if index_indices is None:
             indices = librosa.effects.split(
                 audio, hop_length=self.args.hop_length, top_db=self.args.top_db
@@ -49,33 +124,36 @@ class DatasetVoiceBank:
         else:
             indices = index_indices
 
-        audio_remove_slience = np.zeros_like(audio)
+        mask = np.zeros(audio.shape[-1], dtype=bool)
         for index in indices:
-            audio_remove_slience[index[0] : index[1]] = audio[index[0] : index[1]]
+            mask[index[0] : index[1]] = True
+        audio_remove_slience = np.where(mask, audio, 0)
 
-        for index in indices:
-            trimed_audio.extend(audio[index[0] : index[1]])
+        trimed_audio = np.concatenate(
+            [audio[index[0] : index[1]] for index in indices]
+            if len(indices) > 0
+            else [audio[:0]]
+        )
 
-        return indices, np.array(trimed_audio)
+        return indices, trimed_audio
 
     def _phase_aware_scaling(self, clean_spectral_magnitude, clean_phase, noise_phase):
         assert clean_phase.shape == noise_phase.shape, "Shapes must match."
-        return clean_spectral_magnitude * np.cos(clean_phase - noise_phase)
-
-    def audio_process(self, filename):
-        clean_filename, noisy_filename = filename
-        assert (
-            clean_filename.split("/")[-1] == noisy_filename.split("/")[-1]
-        ), "filename must match."
-
-        name = (
-            clean_filename.split("/")[-1].split(".")[0]
-            + "_"
-            + clean_filename.split("/")[-1].split(".")[1]
-        )
+        return _phase_aware(clean_spectral_magnitude, clean_phase, noise_phase)
 
+    def _read_audio_pair(self, filename):
+        clean_filename, noisy_filename = [os.fsdecode(f) for f in filename]
         clean_audio, sr = read_audio(clean_filename, self.args.sample_rate)
         noisy_audio, sr = read_audio(noisy_filename, self.args.sample_rate)
+        return clean_audio.astype(np.float32, copy=False), noisy_audio.astype(
+            np.float32, copy=False
+        )
+
+    def audio_process(self, filename, audio=None):
+        if audio is None:
+            clean_audio, noisy_audio = self._read_audio_pair(filename)
+        else:  # already read, e.g. prefetched by tf.data
+            clean_audio, noisy_audio = audio
 
         if not self.args.segment_normalization:
             clean_audio = encode_normalize(clean_audio, self.args.normalize)
@@ -98,64 +176,119 @@ class DatasetVoiceBank:
             noisy_audio = encode_normalize(noisy_audio, self.args.normalize)
 
         if self.args.fft:
-            # extract stft features from noisy audio
-            noisy_input_fe = FeatureExtractor(
-                noisy_audio,
-                windowLength=self.args.win_length,
-                hop_length=self.args.hop_length,
-                sample_rate=self.args.sample_rate,
+            # extract stft features from noisy and clean audio at once
+            real, imag = _stft_features(
+                tf.stack([noisy_audio, clean_audio]),
+                frame_length=self.args.win_length,
+                frame_step=self.args.hop_length,
+                fft_length=self.args.n_fft,
+                center=self.args.center,
             )
-            noisy_spectrogram = noisy_input_fe.get_stft_spectrogram(self.args.center)
 
-            # Or get the phase angle (in radians)
-            # noisy_stft_magnitude, noisy_stft_phase = librosa.magphase(noisy_stft_features)
-            noisy_phase = np.angle(noisy_spectrogram)
+            # half precision is enough for stft features and halves the records
+            noisy_real, clean_real = tf.cast(real, tf.float16).numpy()
+            noisy_imag, clean_imag = tf.cast(imag, tf.float16).numpy()
+            del real, imag
 
-            # get the magnitude of the spectral
-            noisy_magnitude = np.abs(noisy_spectrogram)
-
-            # extract stft features from clean audio
-            clean_audio_fe = FeatureExtractor(
-                clean_audio,
-                windowLength=self.args.win_length,
-                hop_length=self.args.hop_length,
-                sample_rate=self.args.sample_rate,
-            )
-            clean_spectrogram = clean_audio_fe.get_stft_spectrogram(self.args.center)
-            # clean_spectrogram = cleanAudioFE.get_mel_spectrogram()
-
-            # get the clean phase
-            clean_phase = np.angle(clean_spectrogram)
-
-            # get the clean spectral magnitude
-            clean_magnitude = np.abs(clean_spectrogram)
-            # clean_magnitude = 2 * clean_magnitude / np.sum(scipy.signal.hamming(self.args.win_length, sym=False))
-
-            noisy_real, noisy_imag = np.real(noisy_spectrogram), np.imag(
-                noisy_spectrogram
-            )
-            clean_real, clean_imag = np.real(clean_spectrogram), np.imag(
-                clean_spectrogram
-            )
+            data = (noisy_real, clean_real, noisy_imag, clean_imag)
+        else:
+            data = (noisy_audio, clean_audio)
+
+        # serialize in the worker, so the main process only writes down bytes
+        return _pack_examples(self._serialize_examples(data))
+
+    def _audio_process_shared_memory(self, filename):
+        """Hands over the records through shared memory instead of pickling them back"""
+        buffer, offsets = self.audio_process(filename)
+
+        shm = shared_memory.SharedMemory(create=True, size=max(len(buffer), 1))
+        try:
+            shm.buf[: len(buffer)] = buffer
+        except BaseException:
+            shm.close()
+            shm.unlink()
+            raise
+        # the main process attaches and unlinks it after writing down. Spawned
+        # workers share its resource tracker, which unlinks leftovers at exit.
+        shm.close()
+
+        return shm.name, offsets
+
+    def _serialize_examples(self, data):
+        examples = []
+        if self.args.fft:
+            noisy_stft_real = data[0]
+            clean_stft_real = data[1]
+            noisy_stft_imag = data[2]
+            clean_stft_imag = data[3]
+            if self.debug:
+                print("  Getting from preprocess")
+                print(
+                    "[DEBUG]: ",
+                    noisy_stft_real.shape,
+                    noisy_stft_imag.shape,
+                    clean_stft_real.shape,
+                    clean_stft_imag.shape,
+                )
+                print(
+                    "[DEBUG]: ",
+                    noisy_stft_real.dtype,
+                    noisy_stft_imag.dtype,
+                    clean_stft_real.dtype,
+                    clean_stft_imag.dtype,
+                )
+                print("---")
+
+            # segment, frame, freqeuncy
+            for idata in range(noisy_stft_real.shape[0]):
+                # 1, frame, freqeuncy
+                noisy_real = noisy_stft_real[idata : idata + 1]
+                clean_real = clean_stft_real[idata : idata + 1]
+                noisy_imag = noisy_stft_imag[idata : idata + 1]
+                clean_imag = clean_stft_imag[idata : idata + 1]
+
+                if self.debug:
+                    print("  Write Down to tfrecord")
+                    print(
+                        "[DEBUG]: ",
+                        noisy_real.shape,
+                        noisy_imag.shape,
+                        clean_real.shape,
+                        clean_imag.shape,
+                    )
+                    print(
+                        "[DEBUG]: ",
+                        noisy_real.dtype,
+                        noisy_imag.dtype,
+                        clean_real.dtype,
+                        clean_imag.dtype,
+                    )
+                    print("---")
 
-            # called phase aware scaling
-            # clean_magnitude = self._phase_aware_scaling(clean_magnitude, clean_phase, noisy_phase)
-            # scaler = StandardScaler(copy=False, with_mean=True, with_std=True)
-            # noisy_magnitude = scaler.fit_transform(noisy_magnitude)
-            # clean_magnitude = scaler.transform(clean_magnitude)
-
-            return name, (
-                noisy_magnitude,
-                clean_magnitude,
-                noisy_phase,
-                clean_phase,
-                noisy_real,
-                clean_real,
-                noisy_imag,
-                clean_imag,
-            )
+                example = get_tf_feature_real_imag_pair(
+                    noisy_real, clean_real, noisy_imag, clean_imag
+                )
+                examples.append(example.SerializeToString())
         else:
-            return name, (noisy_audio, clean_audio)
+            noisy_audio = data[0]
+            clean_audio = data[1]
+
+            if self.debug:
+                print("[DEBUG]: ", noisy_audio.shape, clean_audio.shape)
+
+            for idata, (noise_segment, clean_segment) in enumerate(
+                zip(noisy_audio, clean_audio)
+            ):
+                if self.debug:
+                    print("  Write Down to tfrecord")
+                    print("[DEBUG]: ", noise_segment.shape, clean_segment.shape)
+                    print("---")
+
+                example = get_tf_feature_sample_pair(
+                    noise_segment, clean_segment
+                )
+                examples.append(example.SerializeToString())
+        return examples
 
     def create_tf_record(self, *, prefix, parallel=False):
         root = self.args.save_path
@@ -163,8 +296,9 @@ class DatasetVoiceBank:
         if self.debug:
             folder = f"{folder}_debug"
 
-        if not os.path.exists(folder):
-            os.mkdir(folder)
+        os.makedirs(folder, exist_ok=True)
+        # list written shards once, instead of a stat call for each of them
+        existing_tfrecords = set(os.listdir(folder))
 
         if self.debug:
             file_name_list = [
@@ -181,183 +315,102 @@ class DatasetVoiceBank:
                 )
             ]
 
-        # If file list for preprocess didn't divide, then it will stack in memory(RAM)
-        start = 0
+        # preprocess at most step files at once, so it won't stack in memory(RAM)
         step = 100
-        end = step
 
         print(f"Total {prefix} file number: {len(file_name_list)}")
 
-        for istep in tqdm.tqdm(range(len(file_name_list) // step), ncols=120):
-            if istep == len(file_name_list) // step - 1:
-                submitted_file_name_list = file_name_list[start:]
-            else:
-                submitted_file_name_list = file_name_list[start:end]
-
-            if parallel:
-                print(f"CPU ", os.cpu_count() - 3 if os.cpu_count() > 4 else 1, "...")
-                out = []
-                pendings = []
-                with ProcessPoolExecutor(
-                    os.cpu_count() - 3 if os.cpu_count() > 4 else 1
-                ) as pool:
-                    for file_name in submitted_file_name_list:
-                        pendings.append(pool.submit(self.audio_process, file_name))
-
-                    for pending in tqdm.tqdm(pendings):
-                        out.append(pending.result())
-                # out = p.map(self.parallel_audio_processing, clean_filenames_sublist)
-            else:
-                out = [
-                    self.audio_process(file_names)
-                    for file_names in submitted_file_name_list
-                ]
-
-            for name, data in out:
-                if self.args.fft:
-                    # noisy_stft_magnitude = data[0]
-                    # clean_stft_magnitude = data[1]
-                    # noisy_stft_phase = data[2]
-                    # clean_stft_phase = data[3]
-                    noisy_stft_real = data[4]
-                    clean_stft_real = data[5]
-                    noisy_stft_imag = data[6]
-                    clean_stft_imag = data[7]
-                    if self.debug:
-                        print("  Getting from preprocess")
-                        print(
-                            "[DEBUG]: ",
-                            noisy_stft_real.shape,
-                            noisy_stft_imag.shape,
-                            clean_stft_real.shape,
-                            clean_stft_imag.shape,
-                        )
-                        print(
-                            "[DEBUG]: ",
-                            noisy_stft_real.dtype,
-                            noisy_stft_imag.dtype,
-                            clean_stft_real.dtype,
-                            clean_stft_imag.dtype,
-                        )
-                        print("---")
-
-                    # segment, ch, frame, freqeuncy
-                    new_axes = np.arange(len(clean_stft_imag.shape))
-                    new_axes[-2:] = new_axes[-1], new_axes[-2]
+        # every batch of files is written to a single compressed shard
+        shards = []
+        for istep, start in enumerate(range(0, len(file_name_list), step)):
+            tfrecord_basename = f"{prefix}_shard{istep:05d}.tfrecords"
+            tfrecord_filename = os.path.join(folder, tfrecord_basename)
+            if tfrecord_basename in existing_tfrecords:
+                print(f"Skipping {tfrecord_filename}")
+                continue
+            shards.append((tfrecord_filename, file_name_list[start : start + step]))
+
+        if parallel:
+            num_workers = os.cpu_count() - 3 if os.cpu_count() > 4 else 1
+            print(f"CPU ", num_workers, "...")
+            # args are given to each worker once, a task only carries file names.
+            # spawn, since tensorflow(cuda) already initialized here is not fork-safe
+            pool = ProcessPoolExecutor(
+                num_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(self.model_name, self.args, self.debug),
+            )
+        else:
+            pool = contextlib.nullcontext()
 
-                    noisy_stft_real = np.transpose(
-                        noisy_stft_real, axes=new_axes
-                    )
-                    clean_stft_real = np.transpose(
-                        clean_stft_real, axes=new_axes
-                    )
-                    noisy_stft_imag = np.transpose(
-                        noisy_stft_imag, axes=new_axes
+            # read audio files in background while computing features, a single
+            # pipeline over every shard so prefetching goes on across shards
+            pending_file_name_list = [
+                file_names for _, shard_file_name_list in shards
+                for file_names in shard_file_name_list
+            ]
+            if pending_file_name_list:
+                audio_dataset = tf.data.Dataset.from_tensor_slices(
+                    pending_file_name_list
+                )
+                audio_dataset = audio_dataset.map(
+                    lambda filename: tf.numpy_function(
+                        self._read_audio_pair, [filename], (tf.float32, tf.float32)
+                    ),
+                    num_parallel_calls=tf.data.AUTOTUNE,
+                )
+                audio_dataset = audio_dataset.prefetch(tf.data.AUTOTUNE)
+                audio_iterator = iter(audio_dataset)
+
+        with pool:
+            for tfrecord_filename, submitted_file_name_list in tqdm.tqdm(
+                shards, ncols=120
+            ):
+                # temporary name until closed, so an interrupted shard is never skipped
+                writer = tf.io.TFRecordWriter(
+                    f"{tfrecord_filename}.tmp",
+                    options=tf.io.TFRecordOptions(
+                        compression_type="GZIP", compression_level=1
+                    ),
+                )
+                if parallel:
+                    results = pool.map(
+                        _process, submitted_file_name_list, chunksize=8
                     )
-                    clean_stft_imag = np.transpose(
-                        clean_stft_imag, axes=new_axes
-                    )  
-                    
-                    if self.debug:
-                        print(" Segmentation")
-                        print(
-                            "[DEBUG]: ",
-                            noisy_stft_real.shape,
-                            noisy_stft_imag.shape,
-                            clean_stft_real.shape,
-                            clean_stft_imag.shape,
-                        )
-                        print(
-                            "[DEBUG]: ",
-                            noisy_stft_real.dtype,
-                            noisy_stft_imag.dtype,
-                            clean_stft_real.dtype,
-                            clean_stft_imag.dtype,
-                        )
-                        print("---")
-
-                    for idata, (
-                        noisy_real,
-                        clean_real,
-                        noisy_imag,
-                        clean_imag,
-                    ) in enumerate(
-                        zip(
-                            noisy_stft_real,
-                            clean_stft_real,
-                            noisy_stft_imag,
-                            clean_stft_imag,
-                        )
+                    try:
+                        # write down each result as soon as it arrives
+                        for shm_name, offsets in tqdm.tqdm(
+                            results, total=len(submitted_file_name_list)
+                        ):
+                            _write_shared_memory(writer, shm_name, offsets)
+                    except Exception:
+                        _unlink_shared_memory(results)
+                        raise
+                else:
+                    for file_names, (clean_audio, noisy_audio) in zip(
+                        submitted_file_name_list,
+                        itertools.islice(audio_iterator, len(submitted_file_name_list)),
                     ):
-                        # 1, ch, frame, freqeuncy
-                        noisy_real = np.expand_dims(noisy_real, axis=0)  
-                        clean_real = np.expand_dims(clean_real, axis=0)
-                        noisy_imag = np.expand_dims(noisy_imag, axis=0)
-                        clean_imag = np.expand_dims(clean_imag, axis=0)
-
-                        if self.debug:
-                            print("  Write Down to tfrecord")
-                            print(
-                                "[DEBUG]: ",
-                                noisy_real.shape,
-                                noisy_imag.shape,
-                                clean_real.shape,
-                                clean_imag.shape,
-                            )
-                            print(
-                                "[DEBUG]: ",
-                                noisy_real.dtype,
-                                noisy_imag.dtype,
-                                clean_real.dtype,
-                                clean_imag.dtype,
-                            )
-                            print("---")
-
-                        example = get_tf_feature_real_imag_pair(
-                            noisy_real, clean_real, noisy_imag, clean_imag
-                        )
-    
-                        tfrecord_filename = (
-                            f"{folder}/{prefix}_{name}_{idata}.tfrecords"
+                        buffer, offsets = self.audio_process(
+                            file_names, (clean_audio.numpy(), noisy_audio.numpy())
                         )
-                        if os.path.isfile(
-                            tfrecord_filename
-                        ):  # [TODO] Why at first time, it goes here?
-                            print(f"Skipping {tfrecord_filename}")
-                            continue
-                        else:
-                            writer = tf.io.TFRecordWriter(tfrecord_filename)
-                            writer.write(example.SerializeToString())
-                            writer.close()
-                else:
-                    noisy_audio = data[0]
-                    clean_audio = data[1]
+                        for example in _unpack_examples(buffer, offsets):
+                            writer.write(example)
+                writer.close()
+                os.replace(f"{tfrecord_filename}.tmp", tfrecord_filename)
 
-                    if self.debug:
-                        print("[DEBUG]: ", noisy_audio.shape, clean_audio.shape)
 
-                    for idata, (noise_segment, clean_segment) in enumerate(
-                        zip(noisy_audio, clean_audio)
-                    ):
-                        if self.debug:
-                            print("  Write Down to tfrecord")
-                            print("[DEBUG]: ", noise_segment.shape, clean_segment.shape)
-                            print("---")
+_worker_dataset = None
 
-                        example = get_tf_feature_sample_pair(
-                            noise_segment, clean_segment
-                        )
-                        tfrecord_filename = (
-                            f"{folder}/{prefix}_{name}_{idata}.tfrecords"
-                        )
-                        if os.path.isfile(tfrecord_filename):
-                            print(f"Skipping {tfrecord_filename}")
-                            continue
-                        else:
-                            writer = tf.io.TFRecordWriter(tfrecord_filename)
-                            writer.write(example.SerializeToString())
-                            writer.close()
-
-            del out  # resolve memory leak
-            start += step
-            end += step
+
+def _init_worker(name, args, debug):
+    """Dataset of each worker process, it only needs args, not the file lists"""
+    global _worker_dataset
+    # workers compute on cpu, the gpu stays with the main process
+    tf.config.set_visible_devices([], "GPU")
+    _worker_dataset = DatasetVoiceBank([], [], name, args, debug)
+
+
+def _process(filename):
+    return _worker_dataset._audio_process_shared_memory(filename)
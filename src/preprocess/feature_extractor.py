@@ -1,17 +1,26 @@
+import functools
 import librosa
 import scipy.signal as signal
 
 
+@functools.lru_cache(maxsize=None)
+def _get_window(window_length):
+    """Hanning window is built once for each length and shared as read-only"""
+    window = signal.hanning(
+        window_length, sym=False
+    )  # sym true: filter, false: spectral analysis
+    window.flags.writeable = False
+    return window
+
+
 class FeatureExtractor:
-    def __init__(self, audio, *, windowLength, hop_length, sample_rate):
+    def __init__(self, audio, *, windowLength, hop_length, sample_rate, window=None):
         self.audio = audio
         self.fft_length = windowLength
         self.window_length = windowLength
         self.hop_length = hop_length
         self.sample_rate = sample_rate
-        self.window = signal.hanning(
-            self.window_length, sym=False
-        )  # sym true: filter, false: spectral analysis
+        self.window = _get_window(self.window_length) if window is None else window
 
     def get_stft_spectrogram(self, center):
         return librosa.stft(
@@ -7,7 +7,7 @@ import librosa
 
 # import sounddevice as sd
 # import julius # for pytorch
-from resampy import resample
+import soxr
 import soundfile as sf
 import tensorflow as tf
 
@@ -87,8 +87,11 @@ def read_audio(filepath, sample_rate):
     #     div_fac = 1 / np.max(np.abs(audio)) / 3.0
     #     audio = audio * div_fac
     #     # audio = librosa.util.normalize(audio)
-    audio, sr = sf.read(filepath)
-    audio = resample(audio, sr, sample_rate)
+    audio, sr = sf.read(filepath, dtype="float32", always_2d=False)
+    if audio.ndim > 1:
+        audio = np.mean(audio, axis=-1)
+    if sr != sample_rate:
+        audio = soxr.resample(audio, sr, sample_rate, quality="HQ")
 
     return audio, sr
 
@@ -176,16 +179,19 @@ def get_tf_feature_mag_phase_pair(
     return example
 
 def get_tf_feature_real_imag_pair(
-    noisy_stft_real, clean_stft_real, noise_stft_imag, clean_stft_imag
+    noisy_stft_real, clean_stft_real, noise_stft_imag, clean_stft_imag, dtype=np.float16
 ):
-    noisy_stft_real = noisy_stft_real.astype(np.float32).tostring()
-    clean_stft_real = clean_stft_real.astype(np.float32).tostring()
-    noise_stft_imag = noise_stft_imag.astype(np.float32).tostring()
-    clean_stft_imag = clean_stft_imag.astype(np.float32).tostring()
+    """Stft features are stored as raw bytes of dtype, tagged in "dtype" for decoding"""
+    dtype = np.dtype(dtype)
+    noisy_stft_real = noisy_stft_real.astype(dtype, copy=False).tobytes()
+    clean_stft_real = clean_stft_real.astype(dtype, copy=False).tobytes()
+    noise_stft_imag = noise_stft_imag.astype(dtype, copy=False).tobytes()
+    clean_stft_imag = clean_stft_imag.astype(dtype, copy=False).tobytes()
 
     example = tf.train.Example(
         features=tf.train.Features(
             feature={
+                "dtype": _bytes_feature(dtype.name.encode()),
                 "noisy_stft_real": _bytes_feature(noisy_stft_real),
                 "clean_stft_real": _bytes_feature(clean_stft_real),
                 "noisy_stft_imag": _bytes_feature(noise_stft_imag),
@@ -210,7 +216,11 @@ def get_tf_feature_sample_pair(noisy, clean):
     return example
 
 
-def stft_tensorflow(wav, nfft, hop_length, center=True, normalize=True):
+def stft_tensorflow(wav, nfft, hop_length, center=True, normalize=True, fft_length=None):
+    """Real-input stft, the last axis has (fft_length or nfft) // 2 + 1 frequency bins"""
+    if fft_length is None:
+        fft_length = nfft
+
     if center:
         padding = [(0, 0) for _ in range(len(wav.get_shape()))]
         padding[-1] = (int(nfft // 2), int(nfft // 2))
@@ -221,6 +231,7 @@ def stft_tensorflow(wav, nfft, hop_length, center=True, normalize=True):
         wav,
         frame_length=nfft,
         frame_step=hop_length,
+        fft_length=fft_length,
         window_fn=window_fn,
         pad_end=False,
     )
@@ -489,20 +500,6 @@ def segment_audio(audio, sample_rate, segment):
     else:
         newshape = [audio.shape[:-1]] + [nsegment, num_sample_segment]
 
-    audio = np.reshape(audio, newshape=newshape)  # ..., segment, samples
-
-    audio_segments = None
-    for isegment in range(audio.shape[-2]):
-        if audio_segments is None:
-            audio_segments = audio[..., isegment, :]
-        else:
-            if audio_segments.shape != audio[..., isegment, :].shape:
-                buf_audio_segment = np.expand_dims(audio[..., isegment, :], axis=0)
-                audio_segments = np.concatenate(
-                    [audio_segments, buf_audio_segment], axis=0
-                )
-            else:
-                audio_segments = np.stack(
-                    [audio_segments, audio[..., isegment, :]], axis=0
-                )
+    # ..., segment, samples, as a view so every segment goes to stft in one batch
+    audio = np.reshape(audio, newshape=newshape)
     return audio